@@ -55,44 +55,80 @@ Versions:
 </plugin>
 """
 import Domoticz
-import xml.etree.ElementTree as xml
+try:
+    from lxml import etree as xml  # libxml2 based parser, faster and lighter on memory
+except ImportError:
+    import xml.etree.ElementTree as xml  # uses the C accelerator (former cElementTree) since python 3.3
 import os
-import glob
-from datetime import datetime
-from datetime import timedelta
+import re
+import time
+import bisect
 
-icons = {"batterylevelfull": "batterylevelfull icons.zip",
-         "batterylevelok": "batterylevelok icons.zip",
-         "batterylevellow": "batterylevellow icons.zip",
-         "batterylevelempty": "batterylevelempty icons.zip"}
+# validated plugin parameters: (field, BasePlugin attribute, label, minimum, maximum,
+# message if below minimum, message if above maximum)
+settings = (("Mode2", "batterylevelfull", "Battery Full", 75, 99,
+             "Specified Battery Full value too low: changed to {}%",
+             "Specified Battery Full value too high: changed to {}%"),
+            ("Mode3", "batterylevelok", "Battery OK", 40, 75,
+             "Specified Battery OK value too low: changed to {}%",
+             "Specified Battery OK value too high: changed to {}%"),
+            ("Mode4", "batterylevellow", "Battery LOW", 10, 25,
+             "Specified Battery LOW value too low: changed to {}%",
+             "Specified Battery LOW value too high: changed to {}%"),
+            ("Mode1", "pollinterval", "polling interval", 30, 1440,
+             "Specified polling interval too short: changed to {} minutes",
+             "Specified polling interval too long: changed to {} minutes (24 hours)"))
 
+# locations of the openzwave cache: standard install, then Synology NAS
+cachedirs = ("./Config", "/volume1/@appstore/domoticz/var")
 
-class zwnode:
+# openzwave cache file names, for version 1.6 and for legacy versions, with the controller home id in hex
+ozwcachefile = re.compile(r"ozwcache_0x[0-9A-Fa-f]{8}\.xml$")
+zwcfgfile = re.compile(r"zwcfg_0x[0-9A-Fa-f]{8}\.xml$")
 
-    def __init__(self, nodeid, name, level):
-        self.nodeid = nodeid
-        self.name = name
-        self.level = level
+# path from a Node element to the values of its BATTERY_LEVEL command class... looked up by name since
+# the Value element does not have the same position in openzwave 1.6 cache files and in legacy ones
+# elements are matched whatever their namespace, as openzwave files use a default one: XPath for lxml...
+batterypath = ("./*[local-name()='CommandClasses']/*[local-name()='CommandClass'][@id='128']"
+               "/*[local-name()='Value']")
+# ... and the same path with ElementPath namespace wildcards for ElementTree
+batteryelementpath = "./{*}CommandClasses/{*}CommandClass[@id='128']/{*}Value"
+
+# (image key, icon file) pairs, in decreasing order of battery level
+icons = (("batterylevelfull", "batterylevelfull icons.zip"),
+         ("batterylevelok", "batterylevelok icons.zip"),
+         ("batterylevellow", "batterylevellow icons.zip"),
+         ("batterylevelempty", "batterylevelempty icons.zip"))
 
 
 class BasePlugin:
 
     def __init__(self):
         self.debug = False
-        self.BatteryNodes = []      # work list that contains 'zwnode' objects
-        self.nextupdate = datetime.now()
+        self.BatteryNodes = {}      # work dict of battery nodes: zwave node id -> (name, battery level)
+        self.nextupdate = time.monotonic()    # time of next poll, on a clock immune to wall-clock changes
         self.pollinterval = 60      # default polling interval in minutes
         self.batterylevelfull = 75  # Default values for Battery Levels
         self.batterylevelok   = 50
         self.batterylevellow  = 25
+        self.iconIDs = ()           # Image IDs of the empty, low, ok and full battery icons
+        self.thresholds = ()        # battery levels from which the low, ok and full icons apply
         self.OZWCacheDir = None
         self.OZWVersion = None      # will be 1 for openzwave version before 1.6 or 3 for version 1.6
-                                    # breaking change in index in xml cache)
+                                    # (different cache file name)
         self.zwaveinfofilepath = None
+        self._xml_mtime = None      # modification time of the openzwave file when last parsed...
+        self._xml_cached_nodes = None   # ... and the battery nodes read from it
+        self._last_levels = {}      # battery level of each node at the previous poll
+        try:
+            # compiled lookup of the BATTERY_LEVEL values of a node
+            self.batteryvalues = xml.XPath(batterypath)
+        except AttributeError:
+            # ElementTree has no compiled XPath, use its own ElementPath search instead
+            self.batteryvalues = lambda node: node.findall(batteryelementpath)
         return
 
     def onStart(self):
-        global icons
         Domoticz.Debug("onStart called")
         if Parameters["Mode6"] == 'Debug':
             self.debug = True
@@ -101,81 +137,44 @@ class BasePlugin:
         else:
             Domoticz.Debugging(0)
             
-        # Load custom battery levels
-        # Battery  Full
-        try:
-            temp = int(Parameters["Mode2"])
-        except:
-            Domoticz.Error("Invalid Battery Full parameter")
-        else:
-            if temp < 75:
-                temp = 75
-                Domoticz.Error("Specified Battery Full value too low: changed to 75%")
-            elif temp > 99:
-                temp = 99
-                Domoticz.Error("Specified Battery Full value too high: changed to 99%")
-            self.batterylevelfull = temp
+        # Load custom battery levels and polling interval, within their allowed range
+        for field, attribute, label, low, high, toolow, toohigh in settings:
+            try:
+                temp = int(Parameters[field])
+            except (ValueError, TypeError):
+                Domoticz.Error("Invalid {} parameter".format(label))
+            else:
+                if temp < low:
+                    temp = low
+                    Domoticz.Error(toolow.format(temp))
+                elif temp > high:
+                    temp = high
+                    Domoticz.Error(toohigh.format(temp))
+                setattr(self, attribute, temp)
         Domoticz.Log("Setting battery level to full if greater or equal than {} percent".format(self.batterylevelfull))
-            
-        # Battery OK
-        try:
-            temp = int(Parameters["Mode3"])
-        except:
-            Domoticz.Error("Invalid Battery OK parameter")
-        else:
-            if temp < 40:
-                temp = 40
-                Domoticz.Error("Specified Battery OK value too low: changed to 40%")
-            elif temp > 75:
-                temp = 75
-                Domoticz.Error("Specified Battery OK value too high: changed to 75%")   
-            self.batterylevelok = temp
         Domoticz.Log("Setting battery level to normal if greater or equal than {} percent".format(self.batterylevelok))
-            
-        # Battery LOW
-        try:
-            temp = int(Parameters["Mode4"])
-        except:
-            Domoticz.Error("Invalid Battery LOW parameter")
-        else:
-            if temp < 10:
-                temp = 10
-                Domoticz.Error("Specified Battery LOW value too low: changed to 10%")
-            elif temp > 25:
-                temp = 25
-                Domoticz.Error("Specified Battery LOW value too high: changed to 25%")
-            self.batterylevellow = temp
         Domoticz.Log("Setting battery level to empty if less or equal than {} percent".format(self.batterylevellow))
-        
+        Domoticz.Log("Using polling interval of {} minutes".format(str(self.pollinterval)))
+
         # load custom battery images
-        for key, value in icons.items():
+        for key, value in icons:
             if key not in Images:
                 Domoticz.Image(value).Create()
                 Domoticz.Debug("Added icon: " + key + " from file " + value)
-        Domoticz.Debug("Number of icons loaded = " + str(len(Images)))
-        for image in Images:
-            Domoticz.Debug("Icon " + str(Images[image].ID) + " " + Images[image].Name)
-
-        # check polling interval parameter
-        try:
-            temp = int(Parameters["Mode1"])
-        except:
-            Domoticz.Error("Invalid polling interval parameter")
-        else:
-            if temp < 30:
-                temp = 30  # minimum polling interval
-                Domoticz.Error("Specified polling interval too short: changed to 30 minutes")
-            elif temp > 1440:
-                temp = 1440  # maximum polling interval is 1 day
-                Domoticz.Error("Specified polling interval too long: changed to 1440 minutes (24 hours)")
-            self.pollinterval = temp
-        Domoticz.Log("Using polling interval of {} minutes".format(str(self.pollinterval)))
+        if self.debug:
+            Domoticz.Debug("Number of icons loaded = " + str(len(Images)))
+            for image in Images:
+                Domoticz.Debug("Icon " + str(Images[image].ID) + " " + Images[image].Name)
+        # resolve once the icon IDs and the levels at which they apply, in increasing order of battery level
+        self.iconIDs = tuple(Images[key].ID for key, value in reversed(icons))
+        self.thresholds = (self.batterylevellow, self.batterylevelok, self.batterylevelfull)
+        self._last_levels = {}  # so that all devices get their icon for these thresholds at the first poll
 
         # check if we are running on a standard install or a Synology NAS or if not supported...
-        if os.path.isdir("./Config"):
-            self.OZWCacheDir = "./Config"
-        elif os.path.isdir("/volume1/@appstore/domoticz/var"):
-            self.OZWCacheDir = "/volume1/@appstore/domoticz/var"
+        for cachedir in cachedirs:
+            if os.path.isdir(cachedir):
+                self.OZWCacheDir = cachedir
+                break
         else:
             Domoticz.Error("Cannot locate openzwave cache ! plugin will not be functional")
 
@@ -186,84 +185,141 @@ class BasePlugin:
 
 
     def onHeartbeat(self):
-        now = datetime.now()
+        now = time.monotonic()
         if now >= self.nextupdate:
-            self.nextupdate = now + timedelta(minutes=self.pollinterval)
+            self.nextupdate = now + self.pollinterval * 60
             self.pollnodes()
 
     # BatteryLevel specific methods
 
     def pollnodes(self):
-        self.BatteryNodes = []
+        self.BatteryNodes = {}
         
         if not self.OZWCacheDir:  # do nothing if openzwave cache location unknown
             return
 
+        # keep using the zwave controller file found at a previous poll, as long as it is still there and
+        # updated within the last 2 hours: a single stat per poll rather than a new scan of the cache directory
+        filestat = None
+        if self.zwaveinfofilepath:
+            try:
+                filestat = os.stat(self.zwaveinfofilepath)
+            except FileNotFoundError:  # e.g. cache being rebuilt
+                self.zwaveinfofilepath = None
+            except OSError as err:
+                Domoticz.Error("Error reading openzwave file {}: {}".format(self.zwaveinfofilepath, err))
+                self.zwaveinfofilepath = None
+            else:
+                if time.time() - filestat.st_mtime > 7200:
+                    self.zwaveinfofilepath = None
+
         if not self.zwaveinfofilepath:
             # we have not yet read the OZW cache file (plugin just started or the cache was being rebuilt)
-            # find zwave controller(s)... start with openzwave 1.6 file if it exists
-            controllers = glob.glob(os.path.join(self.OZWCacheDir, "ozwcache_0x????????.xml"))
-            self.OZWVersion = 3
-            if not controllers:
-                # previous test failed... try openzwave legacy (version < 1.6) file
-                controllers = glob.glob(os.path.join(self.OZWCacheDir, "zwcfg_0x????????.xml"))
-                self.OZWVersion = 1
-
-            for controller in controllers:
-                lastmod = datetime.fromtimestamp(os.stat(controller).st_mtime)
-                if lastmod < datetime.now() - timedelta(hours=2):
-                    Domoticz.Error(
-                        "Ignoring controller {} since presumed dead (not updated for more than 2 hours)".format(
-                            controller))
-                    self.zwaveinfofilepath = None
-                else:
-                    self.zwaveinfofilepath = controller
-                    break  # plugin only deals with the first valid zwave controller found
+            filestat = self.findcontroller()
 
         if not self.zwaveinfofilepath:
             Domoticz.Error("Unable to find a zwave controller configuration file !")
         else:
-            # poll the openzwave file
+            # poll the openzwave file, unless it was not rewritten since the previous poll
             try:
-                zwavexml = xml.parse(self.zwaveinfofilepath)
-                zwave = zwavexml.getroot()
-            except Exception as err:
+                mtime = filestat.st_mtime_ns
+                if mtime == self._xml_mtime and self._xml_cached_nodes is not None:
+                    nodes = self._xml_cached_nodes
+                else:
+                    nodes = self.readnodes(self.zwaveinfofilepath)
+            except (OSError, xml.ParseError, ValueError, TypeError) as err:
                 Domoticz.Error("Error reading openzwave file {}: {}".format(self.zwaveinfofilepath, err))
             else:
-                for node in zwave:
-                    for commandclass in node[1]:  # node[1] is the list of CommandClasses
-                        if commandclass.attrib["id"] == "128":  # CommandClass id=128 is BATTERY_LEVEL
-                            self.BatteryNodes.append(zwnode(int(node.attrib["id"]), node.attrib["name"],
-                                                            int(commandclass[self.OZWVersion].attrib["value"])))
-                            break
-
-        for node in self.BatteryNodes:
-            Domoticz.Debug("Node {} {} has battery level of {}%".format(node.nodeid, node.name, node.level))
+                self.BatteryNodes = nodes
+                self._xml_mtime = mtime
+                self._xml_cached_nodes = nodes
+
+        levels = {}
+        debug, devices, lastlevels, updatedevice = self.debug, Devices, self._last_levels, self.UpdateDevice
+        for nodeid, (name, level) in self.BatteryNodes.items():
+            if debug:
+                Domoticz.Debug("Node {} {} has battery level of {}%".format(nodeid, name, level))
             # if device does not yet exist, then create it
-            if not (node.nodeid in Devices):
-                Domoticz.Device(Name=node.name, Unit=node.nodeid, TypeName="Custom",
-                                Options={"Custom": "1;%"}).Create()
-            self.UpdateDevice(node.nodeid, str(node.level))
+            if not (nodeid in devices):
+                Domoticz.Device(Name=name, Unit=nodeid, TypeName="Custom", Options={"Custom": "1;%"}).Create()
+            elif lastlevels.get(nodeid) == level:
+                levels[nodeid] = level
+                continue  # nothing to do if no change since the previous poll
+            if updatedevice(nodeid, level):  # else the update is tried again at the next poll
+                levels[nodeid] = level
+        self._last_levels = levels
+
+
+    def findcontroller(self):
+        # returns the file status of the zwave controller file found, if any
+        # find zwave controller(s) in a single pass of the cache directory...
+        # openzwave 1.6 files are preferred over the legacy (version < 1.6) ones if both exist
+        controllers = {3: [], 1: []}
+        try:
+            with os.scandir(self.OZWCacheDir) as entries:
+                for entry in entries:
+                    if not entry.is_file():  # answered from the directory entry type, no stat needed
+                        continue
+                    if ozwcachefile.match(entry.name):
+                        controllers[3].append(entry)
+                    elif zwcfgfile.match(entry.name):
+                        controllers[1].append(entry)
+            self.OZWVersion = 3 if controllers[3] else 1
 
+            now = time.time()
+            for controller in controllers[self.OZWVersion]:
+                filestat = controller.stat()
+                if now - filestat.st_mtime > 7200:
+                    Domoticz.Error(
+                        "Ignoring controller {} since presumed dead (not updated for more than 2 hours)".format(
+                            controller.path))
+                    self.zwaveinfofilepath = None
+                else:
+                    self.zwaveinfofilepath = controller.path
+                    self._xml_cached_nodes = None  # battery nodes read from another file, if any, are not valid
+                    return filestat  # plugin only deals with the first valid zwave controller found
+        except OSError as err:
+            Domoticz.Error("Error reading openzwave cache directory {}: {}".format(self.OZWCacheDir, err))
+            self.zwaveinfofilepath = None
+        return None
+
+
+    def readnodes(self, filepath):
+        # stream the openzwave file one node at a time rather than loading the whole tree
+        nodes = {}
+        depth = 0
+        for event, node in xml.iterparse(filepath, events=("start", "end")):
+            if event == "start":
+                if depth == 0:
+                    zwave = node
+                depth += 1
+                continue
+            depth -= 1
+            # only top level nodes: association groups also contain (empty) Node elements
+            # openzwave files have a default namespace, so compare the tag name without it
+            if depth == 1 and node.tag.rpartition("}")[2] == "Node":
+                values = self.batteryvalues(node)
+                if values:  # the first value of the command class is the battery level
+                    nodes[int(node.get("id"))] = (node.get("name"), int(values[0].get("value")))
+                zwave.clear()  # done with this node, free it (and any previous sibling)
+        return nodes
 
-    def UpdateDevice(self, Unit, Percent):
+
+    def UpdateDevice(self, Unit, levelBatt):
+        # returns True if the device shows this battery level, False if it could not be updated
         # Make sure that the Domoticz device still exists (they can be deleted) before updating it
-        if Unit in Devices:
-            levelBatt = int(Percent)
-            if levelBatt >= self.batterylevelfull:
-                icon = "batterylevelfull"
-            elif levelBatt >= self.batterylevelok:
-                icon = "batterylevelok"
-            elif levelBatt >= self.batterylevellow:
-                icon = "batterylevellow"
-            else:
-                icon = "batterylevelempty"
-            if Devices[Unit].sValue != Percent:  # only update the device if there is a change in value
-                try:
-                    Devices[Unit].Update(nValue=0, sValue=Percent, Image=Images[icon].ID)
-                except:
-                    Domoticz.Error("Failed to update device unit " + str(Unit))
-        return
+        device = Devices.get(Unit)
+        if device is None:
+            return False
+        icon = self.iconIDs[bisect.bisect_right(self.thresholds, levelBatt)]
+        Percent = str(levelBatt)
+        if device.sValue != Percent:  # only update the device if there is a change in value
+            try:
+                device.Update(nValue=0, sValue=Percent, Image=icon)
+            except Exception:
+                Domoticz.Error("Failed to update device unit " + str(Unit))
+                return False
+        return True
 
 
 global _plugin
@@ -283,6 +339,8 @@ def onHeartbeat():
 
 # Generic helper functions
 def DumpConfigToLog():
+    if not _plugin.debug:
+        return
     for x in Parameters:
         if Parameters[x] != "":
             Domoticz.Debug( "'" + x + "':'" + str(Parameters[x]) + "'")
@@ -65,17 +65,50 @@ Versions:
 </plugin>
 """
 import Domoticz
-import json
+try:
+    import orjson as json   # faster decoding of the API responses if available
+except ImportError:
+    import json
 import urllib.parse as parse
-import urllib.request as request
+import http.client as client
 import base64
-from datetime import datetime
-from datetime import timedelta
-
-icons = {"batterylevelfull": "batterylevelfull icons.zip",
-         "batterylevelok": "batterylevelok icons.zip",
-         "batterylevellow": "batterylevellow icons.zip",
-         "batterylevelempty": "batterylevelempty icons.zip"}
+import gzip
+import zlib
+import socket
+import time
+import bisect
+import concurrent.futures
+
+# validated plugin parameters: (field, BasePlugin attribute, label, minimum, maximum,
+# message if below minimum, message if above maximum)
+settings = (("Mode2", "batterylevelfull", "Battery Full", 75, 99,
+             "Specified Battery Full value too low: changed to {}%",
+             "Specified Battery Full value too high: changed to {}%"),
+            ("Mode3", "batterylevelok", "Battery OK", 40, 75,
+             "Specified Battery OK value too low: changed to {}%",
+             "Specified Battery OK value too high: changed to {}%"),
+            ("Mode4", "batterylevellow", "Battery LOW", 10, 25,
+             "Specified Battery LOW value too low: changed to {}%",
+             "Specified Battery LOW value too high: changed to {}%"),
+            ("Mode1", "pollinterval", "polling interval", 30, 1440,
+             "Specified polling interval too short: changed to {} minutes",
+             "Specified polling interval too long: changed to {} minutes (24 hours)"))
+
+# (image key, icon file) pairs, in decreasing order of battery level
+icons = (("batterylevelfull", "batterylevelfull icons.zip"),
+         ("batterylevelok", "batterylevelok icons.zip"),
+         ("batterylevellow", "batterylevellow icons.zip"),
+         ("batterylevelempty", "batterylevelempty icons.zip"))
+
+# Device attributes that UpdateDevice only sends to domoticz if they differ from the current value
+attributegetters = {"TimedOut": lambda device: device.TimedOut,
+                    "BatteryLevel": lambda device: device.BatteryLevel,
+                    "Color": lambda device: getattr(device, "Color", None),
+                    "Image": lambda device: device.Image}
+
+connection = None   # HTTP connection to the domoticz API, reused across polls
+address = None      # IP address of the domoticz host, resolved once
+stopping = False    # set by onStop, so that a failed API call is not retried by the worker thread
 
 
 class BasePlugin:
@@ -83,16 +116,21 @@ class BasePlugin:
     def __init__(self):
         self.debug = False
         self.BatteryNodes = []      # work list that contains 'zwnode' objects
-        self.nextupdate = datetime.now()
+        self.nextupdate = time.monotonic()    # time of next poll, on a clock immune to wall-clock changes
         self.pollinterval = 60      # default polling interval in minutes
         self.batterylevelfull = 75  # Default values for Battery Levels
         self.batterylevelok   = 50
         self.batterylevellow  = 25
+        self.iconIDs = ()           # Image IDs of the empty, low, ok and full battery icons
+        self.thresholds = ()        # battery levels from which the low, ok and full icons apply
+        self._last = {}             # (battery level, timed out) last written to each device
         self.versionOK = False
+        self.headers = {"Connection": "keep-alive", "Accept-Encoding": "gzip"}  # HTTP headers of all domoticz API calls
+        self.executor = None        # worker thread for the API calls, so that heartbeats never wait on domoticz
+        self.request = None         # pending API call of the current poll, if any
         return
 
     def onStart(self):
-        global icons
         if Parameters["Mode6"] == 'Debug':
             self.debug = True
             Domoticz.Debugging(1)
@@ -121,199 +159,198 @@ class BasePlugin:
 
         # proceed with the plugin setup
 
-        # Load custom battery levels
-        # Battery  Full
-        try:
-            temp = int(Parameters["Mode2"])
-        except:
-            Domoticz.Error("Invalid Battery Full parameter")
-        else:
-            if temp < 75:
-                temp = 75
-                Domoticz.Error("Specified Battery Full value too low: changed to 75%")
-            elif temp > 99:
-                temp = 99
-                Domoticz.Error("Specified Battery Full value too high: changed to 99%")
-            self.batterylevelfull = temp
+        # encode once the credentials for the domoticz API calls, into the headers sent with each of them
+        if Parameters["Username"] != "":
+            Domoticz.Debug("Add authentification for user {}".format(Parameters["Username"]))
+            credentials = ('%s:%s' % (Parameters["Username"], Parameters["Password"]))
+            encoded_credentials = base64.b64encode(credentials.encode('ascii'))
+            self.headers["Authorization"] = 'Basic %s' % encoded_credentials.decode("ascii")
+
+        # Load custom battery levels and polling interval, within their allowed range
+        for field, attribute, label, low, high, toolow, toohigh in settings:
+            try:
+                temp = int(Parameters[field])
+            except (ValueError, TypeError):
+                Domoticz.Error("Invalid {} parameter".format(label))
+            else:
+                if temp < low:
+                    temp = low
+                    Domoticz.Error(toolow.format(temp))
+                elif temp > high:
+                    temp = high
+                    Domoticz.Error(toohigh.format(temp))
+                setattr(self, attribute, temp)
         Domoticz.Log("Setting battery level to full if greater or equal than {} percent".format(self.batterylevelfull))
-            
-        # Battery OK
-        try:
-            temp = int(Parameters["Mode3"])
-        except:
-            Domoticz.Error("Invalid Battery OK parameter")
-        else:
-            if temp < 40:
-                temp = 40
-                Domoticz.Error("Specified Battery OK value too low: changed to 40%")
-            elif temp > 75:
-                temp = 75
-                Domoticz.Error("Specified Battery OK value too high: changed to 75%")   
-            self.batterylevelok = temp
         Domoticz.Log("Setting battery level to normal if greater or equal than {} percent".format(self.batterylevelok))
-            
-        # Battery LOW
-        try:
-            temp = int(Parameters["Mode4"])
-        except:
-            Domoticz.Error("Invalid Battery LOW parameter")
-        else:
-            if temp < 10:
-                temp = 10
-                Domoticz.Error("Specified Battery LOW value too low: changed to 10%")
-            elif temp > 25:
-                temp = 25
-                Domoticz.Error("Specified Battery LOW value too high: changed to 25%")
-            self.batterylevellow = temp
         Domoticz.Log("Setting battery level to empty if less or equal than {} percent".format(self.batterylevellow))
-        
+        Domoticz.Log("Using polling interval of {} minutes".format(str(self.pollinterval)))
+
         # load custom battery images
-        for key, value in icons.items():
+        for key, value in icons:
             if key not in Images:
                 Domoticz.Image(value).Create()
                 Domoticz.Debug("Added icon: " + key + " from file " + value)
-        Domoticz.Debug("Number of icons loaded = " + str(len(Images)))
-        for image in Images:
-            Domoticz.Debug("Icon " + str(Images[image].ID) + " " + Images[image].Name)
-
-        # check polling interval parameter
-        try:
-            temp = int(Parameters["Mode1"])
-        except:
-            Domoticz.Error("Invalid polling interval parameter")
-        else:
-            if temp < 30:
-                temp = 30  # minimum polling interval
-                Domoticz.Error("Specified polling interval too short: changed to 30 minutes")
-            elif temp > 1440:
-                temp = 1440  # maximum polling interval is 1 day
-                Domoticz.Error("Specified polling interval too long: changed to 1440 minutes (24 hours)")
-            self.pollinterval = temp
-        Domoticz.Log("Using polling interval of {} minutes".format(str(self.pollinterval)))
-
+        if self.debug:
+            Domoticz.Debug("Number of icons loaded = " + str(len(Images)))
+            for image in Images:
+                Domoticz.Debug("Icon " + str(Images[image].ID) + " " + Images[image].Name)
+        # resolve once the icon IDs and the levels at which they apply, in increasing order of battery level
+        self.iconIDs = tuple(Images[key].ID for key, value in reversed(icons))
+        self.thresholds = (self.batterylevellow, self.batterylevelok, self.batterylevelfull)
+        self._last = {}  # so that all devices get their icon for these thresholds at the first poll
 
     def onStop(self):
+        global connection, stopping
         Domoticz.Debug("onStop called")
         Domoticz.Debugging(0)
+        if self.executor is not None:
+            # domoticz expects the plugin threads to be gone once onStop returns: wake up a pending API call
+            # by shutting down its socket, then wait for the worker thread to exit
+            stopping = True
+            if self.request is not None:
+                self.request.cancel()  # if not yet started
+            sock = getattr(connection, "sock", None)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass  # already closed by the worker thread
+            self.executor.shutdown(wait=True)
+            self.executor = None
+            self.request = None
+        # only now that the worker thread has exited can the connection be released without racing it
+        if connection is not None:
+            connection.close()
+            connection = None
 
 
     def onHeartbeat(self):
         if self.versionOK:
-            now = datetime.now()
-            if now >= self.nextupdate:
-                self.nextupdate = now + timedelta(minutes=self.pollinterval)
-                self.pollnodes()
-
-    def pollnodes(self):
+            # devices are only updated from the plugin thread, with the API answer received since the last heartbeat
+            if self.request is not None and self.request.done():
+                request, self.request = self.request, None  # a failed poll must not block the next ones
+                try:
+                    self.pollnodes(request.result())
+                except Exception as err:
+                    Domoticz.Error("Error polling zwave nodes: {}".format(err))
+            now = time.monotonic()
+            if now >= self.nextupdate and self.request is None:
+                self.nextupdate = now + self.pollinterval * 60
+                if self.executor is None:
+                    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                self.request = self.executor.submit(
+                    DomoticzAPI, "type=command&param=zwavegetbatterylevels&idx={}".format(Parameters["Mode5"]))
+
+    def pollnodes(self, APIjson):
         BatteryNodes = {}
-        APIjson = DomoticzAPI("type=command&param=zwavegetbatterylevels&idx={}".format(Parameters["Mode5"]))
         try:
             nodes = APIjson["result"]
-        except:
+        except (TypeError, KeyError):  # no valid answer from the API
             nodes = []
 
+        debug, devices, last = self.debug, Devices, self._last
         for node in nodes:  # loop all nodes received from domoticz
-            Domoticz.Debug(
-                "Node {} {} has battery level of {}%".format(node["nodeID"], node["nodeName"], node["battery"]))
+            nodeid, name, level = node["nodeID"], node["nodeName"], node["battery"]
+            if debug:
+                Domoticz.Debug("Node {} {} has battery level of {}%".format(nodeid, name, level))
             # if device does not yet exist, then create it
-            if node["battery"] != 255:  # battery level = 255 if not a battery device
-                if not (node["nodeID"] in Devices):
-                    Domoticz.Device(Name=node["nodeName"] if node["nodeName"] != "" else "Node {}".format(node["nodeID"]),
-                                    Unit=node["nodeID"], TypeName="Custom",
+            if level != 255:  # battery level = 255 if not a battery device
+                if not (nodeid in devices):
+                    Domoticz.Device(Name=name if name != "" else "Node {}".format(nodeid),
+                                    Unit=nodeid, TypeName="Custom",
                                     Options={"Custom": "1;%"}).Create()
-                BatteryNodes[node["nodeID"]] = node["battery"]
-
-        for Unit in Devices:  # loop all devices of the plugin and check if we need to update
-            try:
-                levelBatt = int(BatteryNodes[Unit])
-            except KeyError:  # the node is not in the list returned by domoticz... e.g. not yet updated ?
-                UpdateDevice(Unit, TimedOut=True)
-            else:
-                if levelBatt >= self.batterylevelfull:
-                    icon = "batterylevelfull"
-                elif levelBatt >= self.batterylevelok:
-                    icon = "batterylevelok"
-                elif levelBatt >= self.batterylevellow:
-                    icon = "batterylevellow"
-                else:
-                    icon = "batterylevelempty"
-                UpdateDevice(Unit, sValue=str(BatteryNodes[Unit]), TimedOut=False, Image=Images[icon].ID)
+                    last.pop(nodeid, None)  # new device, e.g. deleted then recreated
+                BatteryNodes[nodeid] = level
+
+        # split the devices of the plugin between those in the list returned by domoticz and the others
+        units = devices.keys()
+        iconIDs, thresholds, bisect_right = self.iconIDs, self.thresholds, bisect.bisect_right
+        for Unit in units - BatteryNodes.keys():  # the node is not in the list... e.g. not yet updated ?
+            if last.get(Unit, (None, False))[1]:
+                continue  # already marked as timed out
+            UpdateDevice(Unit, TimedOut=True)
+            last[Unit] = (None, True)
+        for Unit in units & BatteryNodes.keys():  # check if we need to update
+            levelBatt = int(BatteryNodes[Unit])
+            if last.get(Unit) == (levelBatt, False):
+                continue  # nothing to do if no change since the previous poll
+            icon = iconIDs[bisect_right(thresholds, levelBatt)]
+            UpdateDevice(Unit, sValue=str(levelBatt), TimedOut=False, Image=icon)
+            last[Unit] = (levelBatt, False)
 
 
 def UpdateDevice(Unit, **kwargs):
-    if Unit in Devices:
-        # check if kwargs contain an update for nValue or sValue... if not, use the existing one(s)
-        if "nValue" in kwargs:
-            nValue = kwargs["nValue"]
-        else:
-            nValue = Devices[Unit].nValue
-        if "sValue" in kwargs:
-            sValue = kwargs["sValue"]
-        else:
-            sValue = Devices[Unit].sValue
-
-        # build the arguments for the call to Device.Update
-        update_args = {"nValue": nValue, "sValue": sValue}
-        change = False
-        if nValue != Devices[Unit].nValue or sValue != Devices[Unit].sValue:
-            change = True
-        for arg in kwargs:
-            if arg == "TimedOut":
-                if kwargs[arg] != Devices[Unit].TimedOut:
-                    change = True
-                    update_args[arg] = kwargs[arg]
-                Domoticz.Debug("TimedOut = {}".format(kwargs[arg]))
-            if arg == "BatteryLevel":
-                if kwargs[arg] != Devices[Unit].BatteryLevel:
-                    change = True
-                    update_args[arg] = kwargs[arg]
-                Domoticz.Debug("BatteryLevel = {}".format(kwargs[arg]))
-            if arg == "Color":
-                try:
-                    if kwargs[arg] != Devices[Unit].Color:
-                        change = True
-                except:
-                    change = True
-                finally:
-                    if change:
-                        update_args[arg] = kwargs[arg]
-                Domoticz.Debug("Color = {}".format(kwargs[arg]))
-            if arg == "Image":
-                    if kwargs[arg] != Devices[Unit].Image:
-                        change = True
-                        update_args[arg] = kwargs[arg]
-            if arg == "Forced":
-                change = change or kwargs[arg]
+    device = Devices.get(Unit)
+    if device is None:
+        return
+    # check if kwargs contain an update for nValue or sValue... if not, use the existing one(s)
+    nValue = kwargs.get("nValue", device.nValue)
+    sValue = kwargs.get("sValue", device.sValue)
+
+    # build the arguments for the call to Device.Update
+    update_args = {"nValue": nValue, "sValue": sValue}
+    change = nValue != device.nValue or sValue != device.sValue
+    for arg, value in kwargs.items():
+        getter = attributegetters.get(arg)
+        if getter is not None:
+            if value != getter(device):
+                change = True
+                update_args[arg] = value
+            if _plugin.debug:
+                Domoticz.Debug("{} = {}".format(arg, value))
+    change = change or kwargs.get("Forced", False)
+    if _plugin.debug:
         Domoticz.Debug("Change in device {} = {}".format(Unit, change))
-        if change:
-            Devices[Unit].Update(**update_args)
+    if change:
+        device.Update(**update_args)
 
 
 def DomoticzAPI(APICall):
     resultJson = None
-    url = "http://{}:{}/json.htm?{}".format(Parameters["Address"], Parameters["Port"], parse.quote(APICall, safe="&="))
-    Domoticz.Debug("Calling domoticz API: {}".format(url))
+    url = "/json.htm?{}".format(parse.quote(APICall, safe="&="))
+    if _plugin.debug:
+        Domoticz.Debug("Calling domoticz API: {}".format(url))
     try:
-        req = request.Request(url)
-        if Parameters["Username"] != "":
-            Domoticz.Debug("Add authentification for user {}".format(Parameters["Username"]))
-            credentials = ('%s:%s' % (Parameters["Username"], Parameters["Password"]))
-            encoded_credentials = base64.b64encode(credentials.encode('ascii'))
-            req.add_header('Authorization', 'Basic %s' % encoded_credentials.decode("ascii"))
-
-        response = request.urlopen(req)
-        if response.status == 200:
-            resultJson = json.loads(response.read().decode('utf-8'))
+        status, data = DomoticzRequest(url, _plugin.headers)
+        if status == 200:
+            resultJson = json.loads(data)
             if resultJson["status"] != "OK":
                 Domoticz.Error("Domoticz API returned an error: status = {}".format(resultJson["status"]))
                 resultJson = None
         else:
-            Domoticz.Error("Domoticz API: http error = {}".format(response.status))
-    except:
+            Domoticz.Error("Domoticz API: http error = {}".format(status))
+    except (OSError, EOFError, zlib.error, client.HTTPException, ValueError, KeyError, TypeError):
         Domoticz.Error("Error calling '{}'".format(url))
     return resultJson
 
 
+def DomoticzRequest(url, headers):
+    # the connection to domoticz is kept alive between polls, but domoticz may have closed it in between...
+    # in which case we reconnect once before giving up
+    global connection, address
+    for retry in (True, False):
+        if connection is None:
+            if address is None:
+                # first address of the host, IPv4 or IPv6
+                address = socket.getaddrinfo(Parameters["Address"], int(Parameters["Port"]), type=socket.SOCK_STREAM)[0][4][0]
+            connection = client.HTTPConnection(address, int(Parameters["Port"]), timeout=30)
+        try:
+            connection.request("GET", url, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+            break
+        except (client.HTTPException, OSError):
+            connection.close()
+            connection = None
+            if not retry or stopping:
+                address = None  # resolve the host name again at the next poll, in case its address changed
+                raise
+    # the json answer is compressed if domoticz accepted our Accept-Encoding header
+    if response.getheader("Content-Encoding") == "gzip":
+        data = gzip.decompress(data)
+    return response.status, data
+
+
 global _plugin
 _plugin = BasePlugin()
 
@@ -335,6 +372,8 @@ def onHeartbeat():
 
 # Generic helper functions
 def DumpConfigToLog():
+    if not _plugin.debug:
+        return
     for x in Parameters:
         if Parameters[x] != "":
             Domoticz.Debug( "'" + x + "':'" + str(Parameters[x]) + "'")
@@ -29,15 +29,18 @@ Versions:
     0.6.1: update domoticz version check following new version numbering scheme implemented 22/03/2020 in domoticz
     0.7.0: complete revamping to work with MQTT zwave-js-ui as openzwave has been deprecated.
            PREREQUISITE: install paho.mqtt python module "sudo pip install paho.mqtt" (see https://github.com/eclipse/paho.mqtt.python)
+    0.7.1: battery levels now pushed by zwave-js-ui as they change (battery command class value topics),
+           the full nodes list is only requested at connection and at each poll to find new or dead nodes
+           OPTIONAL: python module orjson is used if installed, for faster decoding of MQTT payloads
 """
 """
-<plugin key="BatteryLevel" name="Battery monitoring for Z-Wave nodes" author="logread" version="0.7.0" wikilink="http://www.domoticz.com/wiki/plugins/BatteryLevel.html" externallink="https://github.com/999LV/BatteryLevel">
+<plugin key="BatteryLevel" name="Battery monitoring for Z-Wave nodes" author="logread" version="0.7.1" wikilink="http://www.domoticz.com/wiki/plugins/BatteryLevel.html" externallink="https://github.com/999LV/BatteryLevel">
     <description>
         <h2>Battery Level Plugin</h2><br/>
-        Version 0.7.0 for domoticz version 2022.2 minimum. Prerequisite: "sudo pip install paho.mqtt"
+        Version 0.7.1 for domoticz version 2022.2 minimum. Prerequisite: "sudo pip install paho.mqtt" (optional: "sudo pip install orjson")
         <p>This plugin allows monitoring of the battery level of ZWave devices managed by zwave-js-ui via MQTT.
         </p>
-        <ol><li>It polls at regular intervals domoticz for battery operated nodes and creates/updates a Domoticz device for each.</li>
+        <ol><li>It receives battery levels from zwave-js-ui as they change, and polls at regular intervals zwave-js-ui for battery operated nodes to create/update a Domoticz device for each.</li>
         <li>Each of the devices representing a battery operated z-wave node will allow:
         <ol><li>An easy to read display of the current battery level</li>
         <li>Logging over time like for any Domoticz sensor</li>
@@ -67,34 +70,69 @@ Versions:
 </plugin>
 """
 import Domoticz
-import json
-from datetime import datetime
-from datetime import timedelta
+try:
+    import orjson as json   # faster decoding of the zwave nodes list if available ("sudo pip install orjson")
+except ImportError:
+    import json
+import bisect
+import queue
+import re
+import time
 import paho.mqtt.client as mqtt
 
 
-icons = {"batterylevelfull": "batterylevelfull icons.zip",
-         "batterylevelok": "batterylevelok icons.zip",
-         "batterylevellow": "batterylevellow icons.zip",
-         "batterylevelempty": "batterylevelempty icons.zip"}
+# validated plugin parameters: (field, BasePlugin attribute, label, minimum, maximum,
+# message if below minimum, message if above maximum)
+settings = (("Mode2", "batterylevelfull", "Battery Full", 75, 99,
+             "Specified Battery Full value too low: changed to {}%",
+             "Specified Battery Full value too high: changed to {}%"),
+            ("Mode3", "batterylevelok", "Battery OK", 40, 75,
+             "Specified Battery OK value too low: changed to {}%",
+             "Specified Battery OK value too high: changed to {}%"),
+            ("Mode4", "batterylevellow", "Battery LOW", 10, 25,
+             "Specified Battery LOW value too low: changed to {}%",
+             "Specified Battery LOW value too high: changed to {}%"),
+            ("Mode1", "pollinterval", "polling interval", 30, 1440,
+             "Specified polling interval too short: changed to {} minutes",
+             "Specified polling interval too long: changed to {} minutes (24 hours)"))
+
+# (image key, icon file) pairs, in decreasing order of battery level
+icons = (("batterylevelfull", "batterylevelfull icons.zip"),
+         ("batterylevelok", "batterylevelok icons.zip"),
+         ("batterylevellow", "batterylevellow icons.zip"),
+         ("batterylevelempty", "batterylevelempty icons.zip"))
+
+# zwave-js-ui value topics of the battery command class (0x80) level, for any endpoint, without or with a location
+# the node is either "nodeID_<id>" or the node name, depending on the zwave-js-ui gateway settings
+leveltopics = ("zwave/+/128/+/level", "zwave/+/+/128/+/level")
+
+# zwave-js-ui sanitizes the node name before using it in a topic: blanks become "_" and special characters are dropped
+topicblanks = re.compile(r"\s")
+topicspecials = re.compile(r"[+*#\\.'`!?^=(),\"%[\]:;{}]+")
 
 
 class BasePlugin:
 
     def __init__(self):
-        global batterylevelfull, batterylevelok, batterylevellow
         self.debug = False
         self.BatteryNodes = []      # work list that contains 'zwnode' objects
-        self.nextupdate = datetime.now()
+        self.nextupdate = time.monotonic()    # time of next poll, on a clock immune to wall-clock changes
         self.pollinterval = 60      # default polling interval in minutes
-        batterylevelfull = 75  # Default values for Battery Levels
-        batterylevelok   = 50
-        batterylevellow  = 25
+        self.batterylevelfull = 75  # Default values for Battery Levels
+        self.batterylevelok   = 50
+        self.batterylevellow  = 25
         self.MQTT_OK = False
+        self.iconIDs = ()           # Image IDs of the empty, low, ok and full battery icons
+        self.thresholds = ()        # battery levels from which the low, ok and full icons apply
+        self._last = {}             # (battery level, timed out) last written to each device
+        self.inbox = queue.SimpleQueue()  # MQTT messages received, to be processed in the plugin thread
+        self.nodeids = {}           # (zwave node id, node name) by node name as in the topics, from the last nodes list received
+        self._gw_online = True      # zwave-js-ui gateway status, assumed online until it says otherwise
+        self.topic = ""             # MQTT topics of the zwave-js-ui getNodes API and of the gateway status
+        self.statustopic = ""
 
 
     def onStart(self):
-        global icons, topic, batterylevelfull, batterylevelok, batterylevellow
         if Parameters["Mode6"] == 'Debug':
             self.debug = True
             Domoticz.Debugging(1)
@@ -105,75 +143,38 @@ class BasePlugin:
 
         # proceed with the plugin setup
 
-        # Load custom battery levels
-        # Battery  Full
-        try:
-            temp = int(Parameters["Mode2"])
-        except:
-            Domoticz.Error("Invalid Battery Full parameter")
-        else:
-            if temp < 75:
-                temp = 75
-                Domoticz.Error("Specified Battery Full value too low: changed to 75%")
-            elif temp > 99:
-                temp = 99
-                Domoticz.Error("Specified Battery Full value too high: changed to 99%")
-            batterylevelfull = temp
-        Domoticz.Log("Setting battery level to full if greater or equal than {} percent".format(batterylevelfull))
-
-        # Battery OK
-        try:
-            temp = int(Parameters["Mode3"])
-        except:
-            Domoticz.Error("Invalid Battery OK parameter")
-        else:
-            if temp < 40:
-                temp = 40
-                Domoticz.Error("Specified Battery OK value too low: changed to 40%")
-            elif temp > 75:
-                temp = 75
-                Domoticz.Error("Specified Battery OK value too high: changed to 75%")
-            batterylevelok = temp
-        Domoticz.Log("Setting battery level to normal if greater or equal than {} percent".format(batterylevelok))
-
-        # Battery LOW
-        try:
-            temp = int(Parameters["Mode4"])
-        except:
-            Domoticz.Error("Invalid Battery LOW parameter")
-        else:
-            if temp < 10:
-                temp = 10
-                Domoticz.Error("Specified Battery LOW value too low: changed to 10%")
-            elif temp > 25:
-                temp = 25
-                Domoticz.Error("Specified Battery LOW value too high: changed to 25%")
-            batterylevellow = temp
-        Domoticz.Log("Setting battery level to empty if less or equal than {} percent".format(batterylevellow))
+        # Load custom battery levels and polling interval, within their allowed range
+        for field, attribute, label, low, high, toolow, toohigh in settings:
+            try:
+                temp = int(Parameters[field])
+            except (ValueError, TypeError):
+                Domoticz.Error("Invalid {} parameter".format(label))
+            else:
+                if temp < low:
+                    temp = low
+                    Domoticz.Error(toolow.format(temp))
+                elif temp > high:
+                    temp = high
+                    Domoticz.Error(toohigh.format(temp))
+                setattr(self, attribute, temp)
+        Domoticz.Log("Setting battery level to full if greater or equal than {} percent".format(self.batterylevelfull))
+        Domoticz.Log("Setting battery level to normal if greater or equal than {} percent".format(self.batterylevelok))
+        Domoticz.Log("Setting battery level to empty if less or equal than {} percent".format(self.batterylevellow))
+        Domoticz.Status("Using polling interval of {} minutes".format(str(self.pollinterval)))
 
         # load custom battery images
-        for key, value in icons.items():
+        for key, value in icons:
             if key not in Images:
                 Domoticz.Image(value).Create()
                 Domoticz.Debug("Added icon: " + key + " from file " + value)
-        Domoticz.Debug("Number of icons loaded = " + str(len(Images)))
-        for image in Images:
-            Domoticz.Debug("Icon " + str(Images[image].ID) + " " + Images[image].Name)
-
-        # check polling interval parameter
-        try:
-            temp = int(Parameters["Mode1"])
-        except:
-            Domoticz.Error("Invalid polling interval parameter")
-        else:
-            if temp < 30:
-                temp = 30  # minimum polling interval
-                Domoticz.Error("Specified polling interval too short: changed to 30 minutes")
-            elif temp > 1440:
-                temp = 1440  # maximum polling interval is 1 day
-                Domoticz.Error("Specified polling interval too long: changed to 1440 minutes (24 hours)")
-            self.pollinterval = temp
-        Domoticz.Status("Using polling interval of {} minutes".format(str(self.pollinterval)))
+        if self.debug:
+            Domoticz.Debug("Number of icons loaded = " + str(len(Images)))
+            for image in Images:
+                Domoticz.Debug("Icon " + str(Images[image].ID) + " " + Images[image].Name)
+        # resolve once the icon IDs and the levels at which they apply, in increasing order of battery level
+        self.iconIDs = tuple(Images[key].ID for key, value in reversed(icons))
+        self.thresholds = (self.batterylevellow, self.batterylevelok, self.batterylevelfull)
+        self._last = {}  # so that all devices get their icon for these thresholds at the first update
 
         # create MQQT connection, connect to it and start network loop
         self.client = mqtt.Client()
@@ -181,7 +182,14 @@ class BasePlugin:
         self.client.on_disconnect = on_disconnect
         self.client.on_message = on_message
         self.client.username_pw_set(Parameters["Username"], password=Parameters["Password"])
-        topic = "zwave/_CLIENTS/ZWAVE_GATEWAY-{}/api/getNodes".format(Parameters["Mode5"])
+        self.client.user_data_set(self)  # the callbacks get the plugin instance as their userdata
+        self.topic = "zwave/_CLIENTS/ZWAVE_GATEWAY-{}/api/getNodes".format(Parameters["Mode5"])
+        self.statustopic = "zwave/_CLIENTS/ZWAVE_GATEWAY-{}/status".format(Parameters["Mode5"])
+        # let paho route each subscribed topic to its own callback
+        self.client.message_callback_add(self.topic, on_nodes)
+        self.client.message_callback_add(self.statustopic, on_status)
+        for leveltopic in leveltopics:
+            self.client.message_callback_add(leveltopic, on_level)
         try:
             # establish an asynchronous connection (different thread)
             self.client.connect_async(Parameters["Address"], int(Parameters["Port"]), 60)
@@ -189,6 +197,8 @@ class BasePlugin:
             Domoticz.Error("MQTT connection error: {}".format(err))
         else:
             self.MQTT_OK = True
+            # the nodes list is requested upon connection, next one at the end of the polling interval
+            self.nextupdate = time.monotonic() + self.pollinterval * 60
             Domoticz.Debug("Starting MQTT network loop")
             # launch MQTT network loop thread
             self.client.loop_start()
@@ -203,21 +213,35 @@ class BasePlugin:
 
 
     def onHeartbeat(self):
-        global topic
-        now = datetime.now()
+        # process the MQTT messages received since the previous heartbeat
+        while True:
+            try:
+                process, msg = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                process(self, msg)
+            except Exception as err:  # a bad message must not stop the processing of the next ones
+                Domoticz.Error("Error processing MQTT message on topic {}: {}".format(msg.topic, err))
+
+        now = time.monotonic()
         if now >= self.nextupdate:
-            self.nextupdate = now + timedelta(minutes=self.pollinterval)
-            if self.MQTT_OK:
+            self.nextupdate = now + self.pollinterval * 60
+            if self.MQTT_OK and self._gw_online:
                 Domoticz.Status("Polling MQTT client '{}' for zwave nodes data".format(Parameters["Mode5"]))
-                self.client.publish(topic + "/set", payload='{"args": []}', qos=0, retain=False)
+                self.client.publish(self.topic + "/set", payload='{"args": []}', qos=0, retain=False)
 
 
 def on_connect(client, userdata, flags, rc):
-    global topic
     Domoticz.Debug("Connected to MQTT with result code {}".format(rc))
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
-    client.subscribe(topic)
+    client.subscribe(userdata.topic)
+    client.subscribe(userdata.statustopic)
+    for leveltopic in leveltopics:
+        client.subscribe(leveltopic)
+    # ask for the full nodes list, to know the names and ids of the battery operated nodes
+    client.publish(userdata.topic + "/set", payload='{"args": []}', qos=0, retain=False)
 
 
 def on_disconnect(client, userdata, rc):
@@ -228,92 +252,152 @@ def on_disconnect(client, userdata, rc):
 
 
 def on_message(client, userdata, msg):
-    global topic, batterylevelfull, batterylevelok, batterylevellow
-    Domoticz.Debug("MQTT message received: {}".format(msg.topic))
-    if msg.topic == topic:
-        Domoticz.Debug("MQTT response received")
-        r = json.loads(msg.payload.decode())
-        if r["success"]:
-            BatteryNodes = {}
-            Domoticz.Status("zwave nodes data received from MQTT client '{}'. Updating devices as required.".format(Parameters["Mode5"]))
-            # loop all nodes received from MQTT client
-            for node in r["result"]:
-                if "minBatteryLevel" in node:
-                    Domoticz.Debug("Node {} {} has battery level of {}%".format(node["id"], node["name"], node["minBatteryLevel"]))
-                    if not (int(node["id"]) in Devices):
-                        Domoticz.Device(Name=node["name"] if node["name"] != "" else "Node {}".format(node["id"]), Unit=int(node["id"]),
-                                        TypeName="Custom", Options={"Custom": "1;%"}).Create()
-                    BatteryNodes[int(node["id"])] = int(node["minBatteryLevel"])
-            # loop all devices of the plugin and check if we need to update or mark as not  updated
-            for Unit in Devices:
-                Domoticz.Debug("Unit = {} {}".format(Unit, type(Unit)))
-                try:
-                    levelBatt = int(BatteryNodes[Unit])
-                except KeyError:  # the node is not in the list returned by the MQTT zwave gateway... e.g. not yet updated or deleted ?
-                    UpdateDevice(Unit, TimedOut=True)
-                else:
-                    if levelBatt >= batterylevelfull:
-                        icon = "batterylevelfull"
-                    elif levelBatt >= batterylevelok:
-                        icon = "batterylevelok"
-                    elif levelBatt >= batterylevellow:
-                        icon = "batterylevellow"
-                    else:
-                        icon = "batterylevelempty"
-                    UpdateDevice(Unit, sValue=str(BatteryNodes[Unit]), TimedOut=False, Image=Images[icon].ID)
-        else:
-            Domoticz.Error("MQTT call error: {}".format(r["message"]))
-            for Unit in Devices:  # loop all devices of the plugin and mark as timedout due to bad MQTT status
-                UpdateDevice(Unit, TimedOut=True)
-
-
-def UpdateDevice(Unit, **kwargs):
-    if Unit in Devices:
-        # check if kwargs contain an update for nValue or sValue... if not, use the existing one(s)
-        if "nValue" in kwargs:
-            nValue = kwargs["nValue"]
-        else:
-            nValue = Devices[Unit].nValue
-        if "sValue" in kwargs:
-            sValue = kwargs["sValue"]
-        else:
-            sValue = Devices[Unit].sValue
-
-        # build the arguments for the call to Device.Update
-        update_args = {"nValue": nValue, "sValue": sValue}
-        change = False
-        if nValue != Devices[Unit].nValue or sValue != Devices[Unit].sValue:
-            change = True
-        for arg in kwargs:
-            if arg == "TimedOut":
-                if kwargs[arg] != Devices[Unit].TimedOut:
-                    change = True
-                    update_args[arg] = kwargs[arg]
-                Domoticz.Debug("TimedOut = {}".format(kwargs[arg]))
-            if arg == "BatteryLevel":
-                if kwargs[arg] != Devices[Unit].BatteryLevel:
-                    change = True
-                    update_args[arg] = kwargs[arg]
-                Domoticz.Debug("BatteryLevel = {}".format(kwargs[arg]))
-            if arg == "Color":
-                try:
-                    if kwargs[arg] != Devices[Unit].Color:
-                        change = True
-                except:
-                    change = True
-                finally:
-                    if change:
-                        update_args[arg] = kwargs[arg]
-                Domoticz.Debug("Color = {}".format(kwargs[arg]))
-            if arg == "Image":
-                    if kwargs[arg] != Devices[Unit].Image:
-                        change = True
-                        update_args[arg] = kwargs[arg]
-            if arg == "Forced":
-                change = change or kwargs[arg]
-        Domoticz.Debug("Change in device {} = {}".format(Unit, change))
-        if change:
-            Devices[Unit].Update(**update_args)
+    if userdata.debug:
+        Domoticz.Debug("Unexpected MQTT message received: {}".format(msg.topic))
+
+
+# paho callbacks of the subscribed topics: keep the MQTT network thread free, messages are processed
+# and devices updated from the plugin thread at the next heartbeat
+def on_nodes(client, userdata, msg):
+    userdata.inbox.put((ProcessNodes, msg))
+
+
+def on_level(client, userdata, msg):
+    userdata.inbox.put((ProcessLevel, msg))
+
+
+def on_status(client, userdata, msg):
+    userdata.inbox.put((ProcessStatus, msg))
+
+
+def ProcessNodes(plugin, msg):
+    Domoticz.Debug("MQTT response received")
+    r = json.loads(msg.payload)
+    if r["success"]:
+        # keep only what is needed from the battery operated nodes, so that the full list can be freed
+        nodes = [(int(node["id"]), node["name"], int(node["minBatteryLevel"]))
+                 for node in r["result"] if node.get("minBatteryLevel") is not None]
+        del r
+        BatteryNodes = {}
+        nodeids = {}
+        units = set(Devices.keys())  # units of the existing devices, looked up once
+        Domoticz.Status("zwave nodes data received from MQTT client '{}'. Updating devices as required.".format(Parameters["Mode5"]))
+        # loop all nodes received from MQTT client
+        debug = plugin.debug
+        for nodeid, name, level in nodes:
+            if debug:
+                Domoticz.Debug("Node {} {} has battery level of {}%".format(nodeid, name, level))
+            if name != "":
+                nodeids[topicspecials.sub("", topicblanks.sub("_", name)).strip("/")] = (nodeid, name)
+            BatteryNodes[nodeid] = level
+        plugin.nodeids = nodeids
+        # create the devices of the new battery operated nodes in one pass, before any update
+        for nodeid, name in [(nodeid, name) for nodeid, name, level in nodes if nodeid not in units]:
+            Domoticz.Device(Name=name if name != "" else "Node {}".format(nodeid), Unit=nodeid,
+                            TypeName="Custom", Options={"Custom": "1;%"}).Create()
+            plugin._last.pop(nodeid, None)  # new device, e.g. deleted then recreated
+            units.add(nodeid)
+        # split the devices of the plugin between those to update and those to mark as not updated
+        for Unit in units - BatteryNodes.keys():  # the node is not in the list returned by the MQTT zwave gateway... e.g. not yet updated or deleted ?
+            TimeOutDevice(plugin, Unit)
+        for Unit in units & BatteryNodes.keys():
+            UpdateBattery(plugin, Unit, BatteryNodes[Unit])
+    else:
+        Domoticz.Error("MQTT call error: {}".format(r["message"]))
+        for Unit in Devices:  # loop all devices of the plugin and mark as timedout due to bad MQTT status
+            TimeOutDevice(plugin, Unit)
+
+
+def ProcessLevel(plugin, msg):
+    # battery level value pushed by zwave-js-ui: zwave/[<location>/]<node>/128/<endpoint>/level
+    node = msg.topic.split("/")[-4]
+    if node.startswith("nodeID_"):
+        Unit = int(node[7:])
+        name = "Node {}".format(Unit)
+    elif node in plugin.nodeids:
+        Unit, name = plugin.nodeids[node]
+    else:  # node not in the last nodes list received: will be found at the next poll
+        if plugin.debug:
+            Domoticz.Debug("Ignoring battery level of unknown zwave node {}".format(node))
+        return
+    try:
+        value = json.loads(msg.payload)
+        # payload is either the value alone or a json object with a "value" key, per zwave-js-ui settings
+        levelBatt = int(value["value"] if isinstance(value, dict) else value)
+    except (ValueError, TypeError, KeyError) as err:
+        Domoticz.Error("Invalid battery level received for zwave node {}: {}".format(node, err))
+        return
+    if plugin.debug:
+        Domoticz.Debug("Node {} {} has battery level of {}%".format(Unit, node, levelBatt))
+    if not (Unit in Devices):
+        Domoticz.Device(Name=name, Unit=Unit, TypeName="Custom", Options={"Custom": "1;%"}).Create()
+        plugin._last.pop(Unit, None)  # new device, e.g. deleted then recreated
+    UpdateBattery(plugin, Unit, levelBatt)
+
+
+def ProcessStatus(plugin, msg):
+    # zwave-js-ui gateway status (retained, and set to offline by its last will)
+    try:
+        value = json.loads(msg.payload)
+        online = bool(value["value"] if isinstance(value, dict) else value)
+    except (ValueError, TypeError, KeyError) as err:
+        Domoticz.Error("Invalid status received for MQTT client '{}': {}".format(Parameters["Mode5"], err))
+        return
+    if online == plugin._gw_online:
+        return
+    plugin._gw_online = online
+    if online:
+        Domoticz.Status("MQTT client '{}' is online".format(Parameters["Mode5"]))
+        # ask for a fresh nodes list rather than waiting for the next poll
+        plugin.client.publish(plugin.topic + "/set", payload='{"args": []}', qos=0, retain=False)
+    else:
+        Domoticz.Error("MQTT client '{}' is offline: polling suspended".format(Parameters["Mode5"]))
+        for Unit in Devices:  # loop all devices of the plugin and mark as timedout since no data is available
+            TimeOutDevice(plugin, Unit)
+
+
+def UpdateBattery(plugin, Unit, levelBatt):
+    if plugin._last.get(Unit) == (levelBatt, False):
+        return  # nothing to do if no change since the previous update
+    icon = plugin.iconIDs[bisect.bisect_right(plugin.thresholds, levelBatt)]
+    UpdateDevice(plugin, Unit, sValue=str(levelBatt), TimedOut=False, Image=icon)
+    plugin._last[Unit] = (levelBatt, False)
+
+
+def TimeOutDevice(plugin, Unit):
+    if plugin._last.get(Unit, (None, False))[1]:
+        return  # already marked as timed out
+    UpdateDevice(plugin, Unit, TimedOut=True)
+    plugin._last[Unit] = (None, True)
+
+
+def UpdateDevice(plugin, Unit, **kwargs):
+    device = Devices.get(Unit)
+    if device is None:
+        return
+    # check if kwargs contain an update for nValue or sValue... if not, use the existing one(s)
+    nValue = kwargs.get("nValue", device.nValue)
+    sValue = kwargs.get("sValue", device.sValue)
+
+    # build the arguments for the call to Device.Update, with only the attributes that change
+    update_args = {"nValue": nValue, "sValue": sValue}
+    timedout = kwargs.get("TimedOut")
+    if timedout is not None and timedout != device.TimedOut:
+        update_args["TimedOut"] = timedout
+    batterylevel = kwargs.get("BatteryLevel")
+    if batterylevel is not None and batterylevel != device.BatteryLevel:
+        update_args["BatteryLevel"] = batterylevel
+    color = kwargs.get("Color")
+    if color is not None and color != getattr(device, "Color", None):
+        update_args["Color"] = color
+    image = kwargs.get("Image")
+    if image is not None and image != device.Image:
+        update_args["Image"] = image
+    change = nValue != device.nValue or sValue != device.sValue or len(update_args) > 2
+    if plugin.debug:
+        Domoticz.Debug("Change in device {} = {} {}".format(Unit, change, update_args))
+    if change or kwargs.get("Forced", False):
+        device.Update(**update_args)
 
 
 global _plugin
@@ -337,6 +421,8 @@ def onHeartbeat():
 
 # Generic helper functions
 def DumpConfigToLog():
+    if not _plugin.debug:
+        return
     for x in Parameters:
         if Parameters[x] != "":
             Domoticz.Debug( "'" + x + "':'" + str(Parameters[x]) + "'")